@@ -1,17 +1,428 @@
 # app.py
 import streamlit as st
 import streamlit.components.v1 as components
-import base64, tempfile, os, io, json
-from pathlib import Path
-import requests
+import asyncio, contextlib, logging, mimetypes, os, io, json, queue, re, threading, time, uuid, wave
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Optional
+import aiofiles
+import aiofiles.os
+import aiofiles.tempfile
+from blake3 import blake3
+import httpx
+import orjson
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential
+import azure.cognitiveservices.speech as speechsdk
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+logger = logging.getLogger(__name__)
 
 st.set_page_config(page_title="Voice → AI → Voice", layout="centered")
 st.title("🎤 Voice → AI → Voice (Streamlit)")
 
 # -----------------------
-# Helper: embed a small HTML/JS audio recorder
-# (returns base64 WAV data)
+# Configuration
+# Read from .streamlit/secrets.toml once per process; helpers receive the Config
+# instead of going back to st.secrets on every call.
+# -----------------------
+DEFAULT_SYSTEM_PROMPT = (
+    "You are a voice assistant. Your reply is read aloud: answer in at most two short "
+    "sentences, without lists, markdown or emoji."
+)
+# earlier turns sent with each request (user + assistant messages)
+MAX_HISTORY_MESSAGES = 12
+
+@dataclass(frozen=True)
+class Config:
+    stt_url: Optional[str]
+    stt_key: Optional[str]
+    stt_region: Optional[str]
+    llm_url: Optional[str]
+    llm_key: Optional[str]
+    llm_max_tokens: int
+    llm_system_prompt: str
+    tts_url: Optional[str]
+    tts_key: Optional[str]
+    tts_voice: str
+    ingest_port: int
+    ingest_url: Optional[str]
+    redis_url: Optional[str]
+    cache_ttl: int
+    cache_llm: bool
+
+@st.cache_resource
+def load_config():
+    secrets = st.secrets
+    return Config(
+        stt_url=secrets.get("STT_ENDPOINT"),
+        stt_key=secrets.get("STT_KEY"),
+        stt_region=secrets.get("STT_REGION"),
+        llm_url=secrets.get("LLM_ENDPOINT"),
+        llm_key=secrets.get("LLM_KEY"),
+        llm_max_tokens=int(secrets.get("LLM_MAX_TOKENS", 120)),
+        llm_system_prompt=secrets.get("LLM_SYSTEM_PROMPT", DEFAULT_SYSTEM_PROMPT),
+        tts_url=secrets.get("TTS_ENDPOINT"),
+        tts_key=secrets.get("TTS_KEY"),
+        tts_voice=secrets.get("TTS_VOICE", "default"),
+        ingest_port=int(secrets.get("INGEST_PORT", 8502)),
+        ingest_url=secrets.get("INGEST_URL"),
+        redis_url=secrets.get("REDIS_URL"),
+        cache_ttl=int(secrets.get("CACHE_TTL_SEC", 86400)),
+        cache_llm=bool(secrets.get("CACHE_LLM", False)),
+    )
+
+# -----------------------
+# Shared async HTTP client
+# One event loop runs on a daemon thread for the lifetime of the server process,
+# so the httpx pool (and its keep-alive HTTP/2 connections) survives reruns.
+# -----------------------
+async def prewarm(client, urls):
+    """
+    HEAD each distinct endpoint origin once so TCP/TLS is done before the first turn,
+    and warn when an https origin did not negotiate HTTP/2 (no multiplexing then).
+    """
+    origins = {}
+    for url in map(httpx.URL, urls):
+        origins.setdefault((url.scheme, url.host, url.port), url)
+    responses = await asyncio.gather(*(client.head(url) for url in origins.values()), return_exceptions=True)
+    for url, resp in zip(origins.values(), responses):
+        if isinstance(resp, httpx.Response) and url.scheme == "https" and resp.http_version != "HTTP/2":
+            logger.warning("%s answered over %s; requests to it will not be multiplexed", url.host, resp.http_version)
+
+def silence_wav(seconds=0.1, rate=16000):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b"\0\0" * int(seconds * rate))
+    return buf.getvalue()
+
+async def warm_up(cfg, client):
+    """
+    Pre-warm connections, then send a throwaway TTS ("." in the configured voice) and
+    STT (0.1 s of silence) request so providers that load models on first use do it
+    before the first real turn. Responses and errors are ignored.
+    """
+    await prewarm(client, [url for url in (cfg.stt_url, cfg.llm_url, cfg.tts_url) if url])
+    probes = []
+    if cfg.tts_url and cfg.tts_key:
+        probes.append(client.post(
+            cfg.tts_url,
+            headers={"Authorization": f"Bearer {cfg.tts_key}", "Content-Type": "application/json"},
+            content=orjson.dumps({"text": ".", "voice": cfg.tts_voice}),
+        ))
+    if cfg.stt_url and cfg.stt_key:
+        probes.append(client.post(
+            cfg.stt_url,
+            headers={"Authorization": f"Bearer {cfg.stt_key}"},
+            files={"file": ("warmup.wav", silence_wav(), "audio/wav")},
+        ))
+    await asyncio.gather(*probes, return_exceptions=True)
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised without contacting the endpoint while its circuit breaker is open."""
+
+class CircuitBreaker:
+    """Opens after `fail_max` consecutive failures; after `reset_timeout` s one trial call goes through."""
+
+    def __init__(self, fail_max=5, reset_timeout=30):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def before_call(self, name):
+        if self.opened_at is None:
+            return
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"{name} is failing repeatedly; try again in {remaining:.0f} s.")
+        # half-open: this call is the trial, others wait for another window
+        self.opened_at = time.monotonic()
+
+    def record(self, ok):
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if self.failures >= self.fail_max:
+                self.opened_at = time.monotonic()
+
+# transient failures are retried quickly instead of hanging on one stuck request
+RETRY_POLICY = dict(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.3, max=2),
+    retry=retry_if_exception_type((httpx.ConnectError, httpx.ConnectTimeout,
+                                   httpx.ReadTimeout, httpx.RemoteProtocolError)),
+    reraise=True,
+)
+
+# for expensive uploads: only retry when nothing reached the server yet
+UPLOAD_RETRY_POLICY = dict(
+    RETRY_POLICY,
+    retry=retry_if_exception_type((httpx.ConnectError, httpx.ConnectTimeout)),
+)
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps the real transport with retries and a circuit breaker per endpoint URL.
+    Streamed responses are retried only until their headers arrive. Requests sent with
+    extensions={"upload": True} are not retried once they may have reached the server.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.breakers = defaultdict(CircuitBreaker)
+
+    async def handle_async_request(self, request):
+        endpoint = f"{request.url.host}{request.url.path}"
+        breaker = self.breakers[endpoint]
+        breaker.before_call(endpoint)
+        try:
+            policy = UPLOAD_RETRY_POLICY if request.extensions.get("upload") else RETRY_POLICY
+            async for attempt in AsyncRetrying(**policy):
+                with attempt:
+                    response = await self.transport.handle_async_request(request)
+        except httpx.TransportError:
+            breaker.record(ok=False)
+            raise
+        breaker.record(ok=response.status_code < 500)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+@st.cache_resource
+def get_http_runtime():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="voice-ai-http", daemon=True).start()
+    client = httpx.AsyncClient(
+        transport=ResilientTransport(httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=40, keepalive_expiry=30),
+        )),
+        # read is per chunk, so long streams are fine; a stalled one fails (and retries) fast
+        timeout=httpx.Timeout(connect=3.0, read=20.0, write=10.0, pool=1.0),
+    )
+    # fire-and-forget, once per process: startup does not wait for the warm-up
+    asyncio.run_coroutine_threadsafe(warm_up(load_config(), client), loop)
+    return loop, client
+
+def submit_async(coro):
+    """Schedule `coro` on the shared loop; returns a concurrent.futures.Future."""
+    loop, _ = get_http_runtime()
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+class APIError(Exception):
+    """Raised by the API helpers; the message is shown to the user as-is."""
+
+# -----------------------
+# Result cache
+# Content-addressed (blake3): STT by a hash of the audio bytes, TTS by (voice, text) and,
+# when CACHE_LLM is set, LLM replies by the full message list (system prompt, history,
+# user turn). A small in-process LRU sits in front of Redis (REDIS_URL, optional) so
+# repeats skip the API round-trip.
+# -----------------------
+def content_key(kind, *parts):
+    digest = blake3()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\0")
+    return f"voice-ai:{kind}:{digest.hexdigest()}"
+
+class ResultCache:
+    """In-process LRU in front of an optional Redis; Redis failures count as misses."""
+
+    def __init__(self, redis_client=None, ttl=86400, max_items=256):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.max_items = max_items
+        self.local = OrderedDict()
+
+    def _remember(self, key, value):
+        self.local[key] = value
+        self.local.move_to_end(key)
+        while len(self.local) > self.max_items:
+            self.local.popitem(last=False)
+
+    async def get(self, key):
+        if key in self.local:
+            self.local.move_to_end(key)
+            return self.local[key]
+        if self.redis is None:
+            return None
+        try:
+            value = await self.redis.get(key)
+        except RedisError:
+            return None
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    async def set(self, key, value):
+        self._remember(key, value)
+        if self.redis is not None:
+            try:
+                await self.redis.set(key, value, ex=self.ttl)
+            except RedisError:
+                pass
+
+@st.cache_resource
+def get_result_cache():
+    cfg = load_config()
+    return ResultCache(
+        # short socket timeouts: a stalled Redis must turn into a cache miss, not a stalled turn
+        redis_client=(Redis.from_url(cfg.redis_url, socket_connect_timeout=0.2, socket_timeout=0.2)
+                      if cfg.redis_url else None),
+        ttl=cfg.cache_ttl,
+    )
+
+# -----------------------
+# Streaming STT for the recorder
+# The recorder streams 250 ms MediaRecorder chunks over a websocket (served from
+# the shared loop) into Azure continuous recognition, so the transcript is ready
+# a few hundred ms after the user stops instead of after a full upload.
 # -----------------------
+async def stream_stt(cfg, ws):
+    """Push audio chunks from `ws` into Azure Speech; returns the final transcript."""
+    if not cfg.stt_key or not cfg.stt_region:
+        raise APIError("STT key/region not configured. Check .streamlit/secrets.toml.")
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    parts = []
+
+    def finish(error=None):
+        if not finished.done():
+            if error:
+                finished.set_exception(APIError(error))
+            else:
+                finished.set_result(None)
+
+    def on_recognizing(evt):
+        partial = " ".join(parts + [evt.result.text])
+        asyncio.run_coroutine_threadsafe(ws.send(json.dumps({"partial": partial})), loop)
+
+    def on_recognized(evt):
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
+            parts.append(evt.result.text)
+
+    def on_canceled(evt):
+        error = None
+        if evt.cancellation_details.reason == speechsdk.CancellationReason.Error:
+            error = f"STT API error: {evt.cancellation_details.error_details}"
+        loop.call_soon_threadsafe(finish, error)
+
+    try:
+        speech_config = speechsdk.SpeechConfig(subscription=cfg.stt_key, region=cfg.stt_region)
+        # MediaRecorder emits WebM/Opus; ANY lets the SDK demux it via GStreamer (packages.txt)
+        audio_stream = speechsdk.audio.PushAudioInputStream(
+            stream_format=speechsdk.audio.AudioStreamFormat(
+                compressed_stream_format=speechsdk.AudioStreamContainerFormat.ANY))
+        recognizer = speechsdk.SpeechRecognizer(
+            speech_config=speech_config, audio_config=speechsdk.audio.AudioConfig(stream=audio_stream))
+    except RuntimeError as e:
+        # the SDK packs a native call stack into the message; the last line is the useful part
+        raise APIError(f"Azure Speech SDK error: {str(e).strip().splitlines()[-1]}")
+    recognizer.recognizing.connect(on_recognizing)
+    recognizer.recognized.connect(on_recognized)
+    recognizer.canceled.connect(on_canceled)
+    recognizer.session_stopped.connect(lambda evt: loop.call_soon_threadsafe(finish))
+    recognizer.start_continuous_recognition_async()
+    try:
+        try:
+            async for message in ws:
+                if isinstance(message, bytes):
+                    audio_stream.write(message)
+                elif message == "stop":
+                    break
+        finally:
+            # also on a dropped connection, so the recognizer sees end-of-stream
+            audio_stream.close()
+        await asyncio.wait_for(finished, timeout=10)
+    finally:
+        # wait (off-loop) for the stop to complete before the recognizer is released
+        await asyncio.to_thread(lambda: recognizer.stop_continuous_recognition_async().get())
+    return " ".join(parts)
+
+class RecorderHub:
+    """Recorder/player websocket endpoints, keyed by Streamlit session."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.transcripts = {}
+        self.players = {}
+        self.server = None
+
+    async def start(self, port):
+        self.server = await serve(self.handle, "0.0.0.0", port)
+
+    async def handle(self, ws):
+        kind, _, session_id = ws.request.path.strip("/").partition("/")
+        if kind == "tts":
+            await self.handle_player(ws, session_id)
+        else:
+            await self.handle_recorder(ws, session_id)
+
+    async def handle_player(self, ws, session_id):
+        # TTS audio is pushed to this socket by the pipeline while it is open
+        self.players[session_id] = ws
+        try:
+            await ws.wait_closed()
+        finally:
+            if self.players.get(session_id) is ws:
+                del self.players[session_id]
+
+    async def handle_recorder(self, ws, session_id):
+        self.transcripts.pop(session_id, None)
+        try:
+            try:
+                text = await stream_stt(self.cfg, ws)
+            except (APIError, asyncio.TimeoutError) as e:
+                await ws.send(json.dumps({"error": str(e) or "STT timed out."}))
+                return
+            self.transcripts[session_id] = text
+            await ws.send(json.dumps({"final": text}))
+        except ConnectionClosed:
+            # tab closed or network dropped mid-recording: nothing to report back
+            pass
+
+@st.cache_resource
+def get_recorder_hub():
+    cfg = load_config()
+    hub = RecorderHub(cfg)
+    try:
+        submit_async(hub.start(cfg.ingest_port)).result()
+    except OSError:
+        # e.g. the port is taken by another app instance; the uploader still works
+        logger.exception("could not start the recorder websocket on port %s", cfg.ingest_port)
+        return None
+    return hub
+
+# -----------------------
+# Helper: embed a small HTML/JS audio recorder and a streaming player
+# (the recorder streams audio chunks to the websocket and shows partial transcripts;
+#  the player appends TTS audio to a MediaSource as it arrives)
+# -----------------------
+INGEST_JS = """
+const INGEST_PORT = __INGEST_PORT__;
+const INGEST_URL = __INGEST_URL__;
+const SESSION_ID = '__SESSION_ID__';
+
+function ingestUrl(kind) {
+  // behind TLS or a port-forwarding proxy the socket lives wherever INGEST_URL says
+  if (INGEST_URL) return `${INGEST_URL.replace(/\/+$/, '')}/${kind}/${SESSION_ID}`;
+  let loc;
+  try { loc = window.parent.location; } catch (e) { loc = window.location; }
+  const proto = loc.protocol === 'https:' ? 'wss' : 'ws';
+  return `${proto}://${loc.hostname}:${INGEST_PORT}/${kind}/${SESSION_ID}`;
+}
+"""
+
 RECORDER_HTML = """
 <style>
 button.record-btn { font-size:16px; padding:10px 18px; border-radius:8px;}
@@ -23,198 +434,595 @@ button.stop-btn { background:#e63946; color:white; padding:8px 14px; border-radi
   <p id="status"></p>
 </div>
 <script>
+__INGEST_JS__
 const recordButton = document.getElementById('record');
 const stopButton = document.getElementById('stop');
 const status = document.getElementById('status');
 
+const VAD_SILENCE_MS = __VAD_SILENCE_MS__;
+// RMS level (0..1) treated as speech; echoCancellation/noiseSuppression keep the floor well below it
+const VAD_SPEECH_RMS = 0.015;
+
 let mediaRecorder;
-let audioChunks = [];
+let socket;
+let vadTimer;
+
+// Opus at 24 kbps is ~10x smaller than the browser default; WebM first, Ogg for older Firefox
+function pickMimeType() {
+  const types = ['audio/webm;codecs=opus', 'audio/ogg;codecs=opus'];
+  return types.find(t => MediaRecorder.isTypeSupported(t)) || '';
+}
+
+// Energy-based end-of-utterance detection: once speech was heard, VAD_SILENCE_MS of
+// quiet stops the recorder so the user does not have to click Stop.
+function watchForSilence(stream) {
+  const ctx = new AudioContext();
+  const analyser = ctx.createAnalyser();
+  analyser.fftSize = 1024;
+  ctx.createMediaStreamSource(stream).connect(analyser);
+  const samples = new Float32Array(analyser.fftSize);
+  let heardSpeech = false;
+  let lastVoice = performance.now();
+  vadTimer = setInterval(() => {
+    analyser.getFloatTimeDomainData(samples);
+    const rms = Math.sqrt(samples.reduce((sum, x) => sum + x * x, 0) / samples.length);
+    const now = performance.now();
+    if (rms > VAD_SPEECH_RMS) {
+      heardSpeech = true;
+      lastVoice = now;
+    } else if (heardSpeech && now - lastVoice >= VAD_SILENCE_MS) {
+      stopRecording();
+    }
+  }, 50);
+  return ctx;
+}
+
+function openSocket() {
+  return new Promise((resolve, reject) => {
+    const ws = new WebSocket(ingestUrl('stt'));
+    ws.onopen = () => resolve(ws);
+    ws.onerror = () => reject('could not reach the recorder websocket at ' + ws.url);
+    ws.onmessage = e => {
+      const msg = JSON.parse(e.data);
+      if (msg.partial) status.innerText = '… ' + msg.partial;
+      if (msg.final !== undefined) status.innerText = 'You said: ' + msg.final + ' (press "Process audio")';
+      if (msg.error) status.innerText = 'STT error: ' + msg.error;
+    };
+  });
+}
 
 recordButton.onclick = async () => {
   if (!navigator.mediaDevices) {
     status.innerText = 'getUserMedia not supported in this browser.';
     return;
   }
+  let stream;
   try {
-    const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
-    mediaRecorder = new MediaRecorder(stream);
-    audioChunks = [];
-    mediaRecorder.ondataavailable = e => audioChunks.push(e.data);
-    mediaRecorder.onstop = async () => {
-      const blob = new Blob(audioChunks, { type: 'audio/wav' });
-      const reader = new FileReader();
-      reader.onloadend = () => {
-        const base64data = reader.result.split(',')[1];
-        // send to streamlit
-        const payload = { audio_base64: base64data };
-        // use Streamlit setComponentValue (works in components)
-        window.parent.postMessage({ type: 'STREAMLIT_AUDIO', value: payload }, '*');
-      };
-      reader.readAsDataURL(blob);
+    // mono/16 kHz are hints only: Chrome ignores sampleRate and Opus always encodes at 48 kHz;
+    // the upload size is bounded by audioBitsPerSecond below
+    stream = await navigator.mediaDevices.getUserMedia({
+      audio: { channelCount: 1, sampleRate: 16000, echoCancellation: true, noiseSuppression: true }
+    });
+    socket = await openSocket();
+    mediaRecorder = new MediaRecorder(stream, { mimeType: pickMimeType(), audioBitsPerSecond: 24000 });
+    // each 250 ms chunk goes straight to the server-side recognizer
+    mediaRecorder.ondataavailable = e => { if (e.data.size > 0) socket.send(e.data); };
+    const vadContext = watchForSilence(stream);
+    mediaRecorder.onstop = () => {
+      clearInterval(vadTimer);
+      vadContext.close();
+      stream.getTracks().forEach(t => t.stop());
+      socket.send('stop');
     };
-    mediaRecorder.start();
+    mediaRecorder.start(250);
     status.innerText = 'Recording...';
     recordButton.disabled = true;
     stopButton.disabled = false;
   } catch (err) {
+    // release the microphone if the socket (not the permission) was the problem
+    if (stream) stream.getTracks().forEach(t => t.stop());
     status.innerText = 'Permission denied or error: ' + err;
   }
 };
 
-stopButton.onclick = () => {
+function stopRecording() {
+  clearInterval(vadTimer);
   if (mediaRecorder && mediaRecorder.state !== 'inactive') {
     mediaRecorder.stop();
-    status.innerText = 'Processing audio...';
+    status.innerText = 'Finishing transcription...';
   }
   recordButton.disabled = false;
   stopButton.disabled = true;
-};
+}
+
+stopButton.onclick = stopRecording;
 </script>
 """
 
-# create a simple component that listens for postMessage to get recorder output
-components.html(RECORDER_HTML, height=180)
+PLAYER_HTML = """
+<audio id="player" controls style="width:100%"></audio>
+<script>
+__INGEST_JS__
+const audio = document.getElementById('player');
+let mediaSource, sourceBuffer, pending = [], ended = false;
+
+function startReply() {
+  mediaSource = new MediaSource();
+  sourceBuffer = null;
+  pending = [];
+  ended = false;
+  audio.src = URL.createObjectURL(mediaSource);
+  mediaSource.addEventListener('sourceopen', () => {
+    sourceBuffer = mediaSource.addSourceBuffer('audio/mpeg');
+    sourceBuffer.addEventListener('updateend', flush);
+    flush();
+  }, { once: true });
+  audio.play().catch(() => {});
+}
+
+function flush() {
+  if (!sourceBuffer || sourceBuffer.updating) return;
+  if (pending.length) sourceBuffer.appendBuffer(pending.shift());
+  else if (ended && mediaSource.readyState === 'open') mediaSource.endOfStream();
+}
+
+// without MSE mp3 support we never connect, and replies come back as st.audio clips
+if (window.MediaSource && MediaSource.isTypeSupported('audio/mpeg')) {
+  const ws = new WebSocket(ingestUrl('tts'));
+  ws.binaryType = 'arraybuffer';
+  ws.onmessage = e => {
+    if (e.data === 'start') startReply();
+    else if (e.data === 'end') { ended = true; flush(); }
+    else { pending.push(new Uint8Array(e.data)); flush(); }
+  };
+}
+</script>
+"""
 
-# Listen for messages posted by the component
-# Streamlit doesn't provide a direct message listener, so we read window.postMessage via component return
-# We'll use a tiny trick: a second HTML block that posts the recorded base64 into a known <input> via JS.
-# But simpler: use Streamlit experimental get_query_params hack isn't reliable. So instead use
-# streamlit_javascript component style would be ideal; for brevity, we accept audio upload alternative if not captured.
+def render_ingest_html(html, session_id, **params):
+    for name, value in params.items():
+        html = html.replace(f"__{name.upper()}__", str(value))
+    cfg = load_config()
+    return (html.replace("__INGEST_JS__", INGEST_JS)
+                .replace("__INGEST_PORT__", str(cfg.ingest_port))
+                .replace("__INGEST_URL__", json.dumps(cfg.ingest_url or ""))
+                .replace("__SESSION_ID__", session_id))
 
-st.info("If the recorder did not return audio, please use 'Upload audio' fallback below.")
+recorder_hub = get_recorder_hub()
+recorder_id = st.session_state.setdefault("recorder_id", uuid.uuid4().hex)
+if recorder_hub is not None:
+    vad_silence_ms = st.slider(
+        "VAD silence ms", 200, 1500, 500, step=50,
+        help="Recording stops automatically after this much silence following speech.",
+    )
+    components.html(render_ingest_html(RECORDER_HTML, recorder_id, vad_silence_ms=vad_silence_ms), height=180)
+    st.info("If the recorder is unavailable, please use the 'Upload audio' fallback below.")
+else:
+    st.info("The recorder is unavailable on this server, please use the 'Upload audio' fallback below.")
 
 # Fallback file uploader
 uploaded_file = st.file_uploader("Or upload a .wav/.mp3 file", type=['wav', 'mp3', 'm4a', 'ogg'])
 
-# We attempt to capture messages from the embedded recorder using Streamlit's experimental component value:
-# (when the recorder finishes it posts a message; Streamlit may surface that in `st.experimental_get_query_params` in some environments.
-# To keep this robust, if the recorder doesn't return audio we'll rely on the uploader.)
-#
-# In many Streamlit deployments, you can replace this with an official component like `streamlit-webrtc` or a maintained audio-recorder component.
+if recorder_hub is not None:
+    st.caption("AI voice (streams while the reply is generated)")
+    components.html(render_ingest_html(PLAYER_HTML, recorder_id), height=60)
 
 # -----------------------
 # When we have an audio (uploaded) -> process it
 # -----------------------
-def save_base64_audio_to_file(b64, out_path):
-    audio_bytes = base64.b64decode(b64)
-    with open(out_path, "wb") as f:
-        f.write(audio_bytes)
-    return out_path
+def audio_digest(data):
+    # blake3 is SIMD-accelerated and hashes large buffers on several threads
+    return blake3(data, max_threads=blake3.AUTO).hexdigest()
 
-def call_stt_api(local_file_path):
+STT_UPLOAD_TIMEOUT = httpx.Timeout(connect=3.0, read=120.0, write=30.0, pool=1.0)
+
+async def call_stt_api(cfg, client, cache, audio):
     """
     Replace this with your STT provider. Example: OpenAI Whisper endpoint or AssemblyAI.
+    `audio` is a (filename, bytes, mime) tuple, sent as-is as the multipart file part.
     This function should return the transcribed text as a string.
     """
-    st.info("Sending audio to STT API...")
-    # Example: send audio file to an HTTP endpoint
-    STT_ENDPOINT = st.secrets.get("https://eastasia.api.cognitive.microsoft.com/", None)
-    STT_KEY = st.secrets.get("1f9hcUtjhvtdUv2nhtebXYAQ2SaWu8MjEyrZ0hH37jw1n4ETfgXVJQQJ99BKAC3pKaRXJ3w3AAAYACOG3AV4", None)
-    if not STT_ENDPOINT or not STT_KEY:
-        st.error("STT endpoint/key not configured. Check .streamlit/secrets.toml.")
-        return ""
-    files = {"file": open(local_file_path, "rb")}
-    headers = {"Authorization": f"Bearer {STT_KEY}"}
-    resp = requests.post(STT_ENDPOINT, headers=headers, files=files, timeout=120)
+    if not cfg.stt_url or not cfg.stt_key:
+        raise APIError("STT endpoint/key not configured. Check .streamlit/secrets.toml.")
+    # blake3 releases the GIL while hashing, so a thread keeps the loop free
+    cache_key = content_key("stt", await asyncio.to_thread(audio_digest, audio[1]))
+    if (cached := await cache.get(cache_key)) is not None:
+        return orjson.loads(cached)["text"]
+    headers = {"Authorization": f"Bearer {cfg.stt_key}"}
+    # a long recording can take the provider well past the client's 20 s read timeout;
+    # wait for it instead of timing out and re-sending (and paying for) the upload
+    resp = await client.post(cfg.stt_url, headers=headers, files={"file": audio},
+                             timeout=STT_UPLOAD_TIMEOUT, extensions={"upload": True})
     if resp.status_code != 200:
-        st.error(f"STT API error: {resp.status_code} {resp.text}")
-        return ""
-    data = resp.json()
+        raise APIError(f"STT API error: {resp.status_code} {resp.text}")
+    data = orjson.loads(resp.content)
     # adapt to your API's response format
-    return data.get("text") or data.get("transcript") or data.get("result") or ""
+    text = data.get("text") or data.get("transcript") or data.get("result") or ""
+    if text:
+        await cache.set(cache_key, orjson.dumps({"text": text}))
+    return text
 
-def call_llm_api(user_text):
-    """
-    Replace this with your LLM provider request (OpenAI, or others).
-    Return LLM reply text.
-    """
-    st.info("Sending text to LLM...")
-    LLM_ENDPOINT = st.secrets.get("https://eastasia.api.cognitive.microsoft.com/", None)
-    LLM_KEY = st.secrets.get("1f9hcUtjhvtdUv2nhtebXYAQ2SaWu8MjEyrZ0hH37jw1n4ETfgXVJQQJ99BKAC3pKaRXJ3w3AAAYACOG3AV4", None)
-    if not LLM_ENDPOINT or not LLM_KEY:
-        st.error("LLM endpoint/key not configured. Check .streamlit/secrets.toml.")
-        return ""
-    headers = {"Authorization": f"Bearer {LLM_KEY}", "Content-Type": "application/json"}
-    payload = {"prompt": user_text, "max_tokens": 512}
-    resp = requests.post(LLM_ENDPOINT, headers=headers, json=payload, timeout=60)
-    if resp.status_code != 200:
-        st.error(f"LLM API error: {resp.status_code} {resp.text}")
-        return ""
-    data = resp.json()
-    # adapt to provider: try common fields
+def _words(text):
+    # re-chunk a complete reply so sentence splitting sees it like a stream
+    return re.findall(r"\s*\S+", text)
+
+def _llm_text(data):
+    # adapt to provider: try common fields (full replies and streamed deltas)
     if "choices" in data and len(data["choices"])>0:
-        return data["choices"][0].get("text") or data["choices"][0].get("message", {}).get("content","")
+        choice = data["choices"][0]
+        return (choice.get("delta", {}).get("content") or choice.get("text")
+                or choice.get("message", {}).get("content") or "")
     return data.get("response") or data.get("text") or ""
 
-def call_tts_api(text, out_path):
+async def stream_llm_api(cfg, client, cache, user_text, history=()):
+    """
+    Yields the LLM reply, from the cache (when CACHE_LLM is set) or from the provider.
+    `history` holds earlier turns as chat messages.
+    """
+    messages = [
+        {"role": "system", "content": cfg.llm_system_prompt},
+        *history,
+        {"role": "user", "content": user_text},
+    ]
+    use_cache = cfg.cache_llm
+    cache_key = content_key("llm", orjson.dumps(messages))
+    if use_cache and (cached := await cache.get(cache_key)) is not None:
+        for token in _words(cached.decode()):
+            yield token
+        return
+    reply = ""
+    async for token in _stream_llm_provider(cfg, client, messages):
+        reply += token
+        yield token
+    if use_cache and reply:
+        await cache.set(cache_key, reply.encode())
+
+async def _stream_llm_provider(cfg, client, messages):
+    """
+    Replace this with your LLM provider request (OpenAI, or others).
+    Yields the reply text as it streams in (SSE). Providers that ignore
+    "stream" and answer with plain JSON yield the whole reply word by word.
+    """
+    if not cfg.llm_url or not cfg.llm_key:
+        raise APIError("LLM endpoint/key not configured. Check .streamlit/secrets.toml.")
+    headers = {"Authorization": f"Bearer {cfg.llm_key}", "Content-Type": "application/json"}
+    # short spoken replies: every generated token is also TTS time; a blank line ends the answer.
+    # Resending the same system prompt + history as a prefix lets providers reuse their prompt cache.
+    payload = {"messages": messages, "max_tokens": cfg.llm_max_tokens, "stop": ["\n\n"], "stream": True}
+    async with client.stream("POST", cfg.llm_url, headers=headers, content=orjson.dumps(payload)) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            raise APIError(f"LLM API error: {resp.status_code} {resp.text}")
+        if not resp.headers.get("content-type", "").startswith("text/event-stream"):
+            await resp.aread()
+            for token in _words(_llm_text(orjson.loads(resp.content))):
+                yield token
+            return
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            token = _llm_text(orjson.loads(data))
+            if token:
+                yield token
+
+SENTENCE_END = re.compile(r"[.?!]\s*$")
+
+def is_sentence_boundary(buffer, token):
+    """True once `buffer` ends a sentence, or a clause of at least 4 words."""
+    if SENTENCE_END.search(buffer):
+        return True
+    return token.rstrip().endswith(",") and len(buffer.split()) >= 4
+
+async def stream_tts_api(cfg, client, cache, text):
     """
     Replace with your TTS provider HTTP call.
-    Save result audio to out_path (mp3/wav) and return out_path.
+    Yields audio bytes (mp3) as they arrive; a cache hit yields the whole clip at once.
     """
-    st.info("Requesting TTS audio...")
-    TTS_ENDPOINT = st.secrets.get("https://eastasia.api.cognitive.microsoft.com/", None)
-    TTS_KEY = st.secrets.get("1f9hcUtjhvtdUv2nhtebXYAQ2SaWu8MjEyrZ0hH37jw1n4ETfgXVJQQJ99BKAC3pKaRXJ3w3AAAYACOG3AV4", None)
-    if not TTS_ENDPOINT or not TTS_KEY:
-        st.error("TTS endpoint/key not configured. Check .streamlit/secrets.toml.")
-        return None
-    headers = {"Authorization": f"Bearer {TTS_KEY}", "Content-Type": "application/json"}
-    payload = {"text": text, "voice": st.secrets.get("TTS_VOICE","default")}
-    resp = requests.post(TTS_ENDPOINT, headers=headers, json=payload, timeout=120)
-    if resp.status_code != 200:
-        st.error(f"TTS API error: {resp.status_code} {resp.text}")
-        return None
-    # assume binary audio returned
-    with open(out_path, "wb") as f:
-        f.write(resp.content)
+    if not cfg.tts_url or not cfg.tts_key:
+        raise APIError("TTS endpoint/key not configured. Check .streamlit/secrets.toml.")
+    cache_key = content_key("tts", cfg.tts_voice, text)
+    if (cached := await cache.get(cache_key)) is not None:
+        yield cached
+        return
+    headers = {"Authorization": f"Bearer {cfg.tts_key}", "Content-Type": "application/json"}
+    payload = {"text": text, "voice": cfg.tts_voice, "stream": True}
+    audio = bytearray()
+    async with client.stream("POST", cfg.tts_url, headers=headers, content=orjson.dumps(payload)) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            raise APIError(f"TTS API error: {resp.status_code} {resp.text}")
+        # assume binary audio returned
+        async for chunk in resp.aiter_bytes(chunk_size=4096):
+            audio += chunk
+            yield chunk
+    await cache.set(cache_key, bytes(audio))
+
+async def call_tts_api(cfg, client, cache, text, out_path):
+    """Save the TTS audio for `text` to out_path (mp3) and return out_path."""
+    # aiofiles runs the writes in a thread so the loop keeps serving other streams
+    async with aiofiles.open(out_path, "wb") as f:
+        async for chunk in stream_tts_api(cfg, client, cache, text):
+            await f.write(chunk)
     return out_path
 
+# concurrent TTS requests per reply; playback order is kept by play_in_order
+TTS_CONCURRENCY = 4
+
+async def synthesize_sentence(cfg, client, cache, sentence, limit):
+    # the UI reads and deletes the clip once it has it; remove it here if it never gets there
+    async with aiofiles.tempfile.NamedTemporaryFile("wb", delete=False, suffix=".mp3") as audio_out:
+        out_path = audio_out.name
+    try:
+        async with limit:
+            return await call_tts_api(cfg, client, cache, sentence, out_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            await aiofiles.os.remove(out_path)
+        raise
+
+async def relay_sentence(cfg, client, cache, sentence, chunks, limit):
+    # buffer chunks until it is this sentence's turn to play; None marks the end
+    try:
+        async with limit:
+            async for chunk in stream_tts_api(cfg, client, cache, sentence):
+                chunks.put_nowait(chunk)
+    finally:
+        chunks.put_nowait(None)
+
+def start_sentence(cfg, client, cache, sentence, player, limit):
+    """
+    Start TTS for one sentence: streamed to `player` if connected, else to a temp file.
+    `limit` is the reply's semaphore bounding concurrent TTS requests.
+    """
+    if player is None:
+        return asyncio.create_task(synthesize_sentence(cfg, client, cache, sentence, limit)), None
+    chunks = asyncio.Queue()
+    return asyncio.create_task(relay_sentence(cfg, client, cache, sentence, chunks, limit)), chunks
+
+async def play_in_order(audio_tasks, events, player):
+    """Forward TTS audio to the player (or finished clips to the UI) in sentence order."""
+    if player is not None:
+        await player.send("start")
+    try:
+        while (item := await audio_tasks.get()) is not None:
+            task, chunks = item
+            if chunks is None:
+                events.put(("audio", await task))
+                continue
+            while (chunk := await chunks.get()) is not None:
+                await player.send(chunk)
+            await task  # re-raise TTS errors
+            events.put(("audio", None))
+    finally:
+        # close the browser's MediaSource even when a sentence failed
+        if player is not None:
+            with contextlib.suppress(ConnectionClosed):
+                await player.send("end")
+
+async def run_pipeline(cfg, client, cache, audio, events, user_text=None, player=None, history=()):
+    """
+    STT → streaming LLM → per-sentence TTS over the shared client.
+    STT is skipped when `user_text` already came from the streaming recorder;
+    `history` is the conversation so far as chat messages.
+    TTS audio is streamed to `player` (the page's websocket player) when connected.
+    Progress is reported on `events` (a queue.Queue read by the script thread)
+    as (kind, value) pairs, always ending with ("done", None).
+    """
+    pending = []
+    audio_tasks = asyncio.Queue()
+    try:
+        # 1) STT
+        if user_text is None:
+            user_text = await call_stt_api(cfg, client, cache, audio)
+        if not user_text:
+            events.put(("error", "No transcription returned."))
+            return
+        events.put(("transcript", user_text))
+
+        # 2) LLM, 3) TTS - each finished sentence is synthesized while the LLM keeps generating
+        tts_limit = asyncio.Semaphore(TTS_CONCURRENCY)
+        playback = asyncio.create_task(play_in_order(audio_tasks, events, player))
+        pending.append(playback)
+        reply, buffer = "", ""
+        async for token in stream_llm_api(cfg, client, cache, user_text, history):
+            if playback.done():
+                # TTS/playback failed: re-raise now instead of generating into a dead pipeline
+                await playback
+            events.put(("token", token))
+            reply += token
+            buffer += token
+            if is_sentence_boundary(buffer, token):
+                item = start_sentence(cfg, client, cache, buffer.strip(), player, tts_limit)
+                pending.append(item[0])
+                await audio_tasks.put(item)
+                buffer = ""
+        if buffer.strip():
+            item = start_sentence(cfg, client, cache, buffer.strip(), player, tts_limit)
+            pending.append(item[0])
+            await audio_tasks.put(item)
+        await audio_tasks.put(None)
+        if not reply.strip():
+            events.put(("error", "LLM didn't return a reply."))
+        await playback
+    except APIError as e:
+        events.put(("error", str(e)))
+    except CircuitOpenError as e:
+        events.put(("error", str(e)))
+    except httpx.HTTPError as e:
+        events.put(("error", f"Network error: {e!r}"))
+    except ConnectionClosed:
+        events.put(("error", "Audio player disconnected."))
+    except Exception as e:
+        # anything else (e.g. a malformed provider response) would otherwise vanish with the future
+        logger.exception("voice pipeline failed")
+        events.put(("error", f"Unexpected error: {e!r}"))
+    finally:
+        # barge-in / failure: drop any TTS still in flight; cancelling a task leaves its
+        # `client.stream` block, which closes that response without touching the shared pool
+        for task in pending:
+            task.cancel()
+        # clips that finished but were never handed to the UI
+        while not audio_tasks.empty():
+            if (item := audio_tasks.get_nowait()) is None or item[1] is not None:
+                continue
+            task = item[0]
+            if task.done() and not task.cancelled() and task.exception() is None:
+                with contextlib.suppress(OSError):
+                    await aiofiles.os.remove(task.result())
+        events.put(("done", None))
+
+# -----------------------
+# Progress of the current run
+# The pipeline runs on the shared loop independently of script reruns; a fragment
+# polls its event queue so the page (recorder included) stays interactive.
+# -----------------------
+def read_clip(path):
+    """Load a finished TTS clip into memory and delete its temp file."""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+def discard_clips(events):
+    while True:
+        try:
+            kind, value = events.get_nowait()
+        except queue.Empty:
+            return
+        if kind == "audio" and value:
+            with contextlib.suppress(OSError):
+                os.remove(value)
+
+class PipelineRun:
+    """UI-side state of one STT → LLM → TTS run, filled from the pipeline's events."""
+
+    def __init__(self, future, events):
+        self.future = future
+        self.events = events
+        self.transcript = None
+        self.reply = ""
+        self.clips = []
+        self.errors = []
+        self.done = False
+        self.celebrated = False
+        self.saved = False
+
+    def drain(self):
+        while True:
+            try:
+                kind, value = self.events.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "transcript":
+                self.transcript = value
+            elif kind == "token":
+                self.reply += value
+            elif kind == "audio":
+                # None: the sentence was streamed to the player component
+                self.clips.append(value and read_clip(value))
+            elif kind == "error":
+                self.errors.append(value)
+            elif kind == "done":
+                self.done = True
+
+    def discard(self):
+        """Cancel the run and delete any clips it still produces (barge-in, new conversation)."""
+        self.future.cancel()
+        self.future.add_done_callback(lambda _: discard_clips(self.events))
+
+    def label(self):
+        if self.errors:
+            return "Failed"
+        if self.done:
+            return "Done"
+        if self.transcript is None:
+            return "STT: transcribing..."
+        if not self.clips:
+            return "LLM: generating reply..."
+        return "TTS: speaking..."
+
 # -----------------------
 # Main button to process (if uploader provided)
 # -----------------------
 if st.button("Process audio (STT → LLM → TTS)"):
-    # We see if the embed recorded audio posted to parent; attempt to read from query params or uploader
-    # Fallback: use uploaded file
-    audio_path = None
-    if uploaded_file:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(uploaded_file.name).suffix) as tmp:
-            tmp.write(uploaded_file.read())
-            audio_path = tmp.name
-
-    if not audio_path:
+    # Prefer a fresh recorder transcript; fall back to the uploaded file
+    recorded_text = recorder_hub.transcripts.pop(recorder_id, None) if recorder_hub else None
+    audio = None
+    if uploaded_file and recorded_text is None:
+        # the upload is already in memory: hand its bytes to the STT request, no temp file
+        mime = uploaded_file.type or mimetypes.guess_type(uploaded_file.name)[0] or "application/octet-stream"
+        audio = (uploaded_file.name, uploaded_file.getvalue(), mime)
+
+    if audio is None and recorded_text is None:
         st.warning("No audio available. Use the recorder (top) or upload a file.")
     else:
-        # 1) STT
-        user_text = call_stt_api(audio_path)
-        if not user_text:
-            st.error("No transcription returned.")
-        else:
+        if (previous := st.session_state.get("run")) is not None:
+            # barge-in: drop the previous reply's in-flight LLM/TTS
+            previous.discard()
+        _, client = get_http_runtime()
+        events = queue.Queue()
+        player = recorder_hub.players.get(recorder_id) if recorder_hub else None
+        history = st.session_state.setdefault("chat", [])[-MAX_HISTORY_MESSAGES:]
+        future = submit_async(run_pipeline(
+            load_config(), client, get_result_cache(), audio, events, recorded_text, player, history))
+        st.session_state["run"] = PipelineRun(future, events)
+
+current_run = st.session_state.get("run")
+polling = current_run is not None and not current_run.done
+
+@st.fragment(run_every=0.25 if polling else None)
+def show_run():
+    run = st.session_state.get("run")
+    if run is None:
+        return
+    run.drain()
+    state = "error" if run.errors else "complete" if run.done else "running"
+    with st.status(run.label(), state=state, expanded=True):
+        if run.transcript:
             st.markdown("**You said:**")
-            st.info(user_text)
+            st.info(run.transcript)
+        if run.reply:
+            st.markdown("**AI reply:**")
+            st.success(run.reply)
+        for i, clip in enumerate(c for c in run.clips if c):
+            st.audio(clip, format="audio/mpeg", autoplay=i == 0)
+        for error in run.errors:
+            st.error(error)
+        if run.done and not run.errors and not run.clips:
+            st.error("TTS failed.")
+    if run.done and not run.saved and not run.errors and run.reply:
+        run.saved = True
+        st.session_state.setdefault("chat", []).extend([
+            {"role": "user", "content": run.transcript},
+            {"role": "assistant", "content": run.reply},
+        ])
+    if run.done and polling:
+        # full rerun with polling off
+        st.rerun()
+    if run.done and not run.celebrated and not run.errors and run.clips:
+        run.celebrated = True
+        st.balloons()
 
-            # 2) LLM
-            ai_reply = call_llm_api(user_text)
-            if not ai_reply:
-                st.error("LLM didn't return a reply.")
-            else:
-                st.markdown("**AI reply:**")
-                st.success(ai_reply)
+show_run()
 
-                # 3) TTS - generate audio
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as audio_out:
-                    out_path = audio_out.name
-                tts_file = call_tts_api(ai_reply, out_path)
-                if tts_file:
-                    st.audio(tts_file)
-                    st.balloons()
-                else:
-                    st.error("TTS failed.")
+if st.session_state.get("chat") and st.button("New conversation"):
+    st.session_state["chat"] = []
+    if (previous := st.session_state.pop("run", None)) is not None:
+        previous.discard()
+    st.rerun()
 
 # -----------------------
 # Show secrets helper (only non-empty keys masked)
 # -----------------------
 if st.checkbox("Show configured APIs (keys masked)"):
+    cfg = load_config()
     st.write({
-        "STT_ENDPOINT": bool(st.secrets.get("STT_ENDPOINT")),
-        "LLM_ENDPOINT": bool(st.secrets.get("LLM_ENDPOINT")),
-        "TTS_ENDPOINT": bool(st.secrets.get("TTS_ENDPOINT")),
+        "STT_ENDPOINT": bool(cfg.stt_url),
+        "LLM_ENDPOINT": bool(cfg.llm_url),
+        "TTS_ENDPOINT": bool(cfg.tts_url),
     })